@@ -4,12 +4,8 @@ Collection of functions that compute stuff using
 as input data produced with the classical psha method.
 """
 
-import math
 import numpy
 
-from scipy.interpolate import interp1d # pylint: disable=E1101, E0611
-from scipy.stats.mstats import mquantiles
-
 from openquake import kvs
 from openquake import shapes
 from openquake.logs import LOG
@@ -18,6 +14,18 @@ from openquake.logs import LOG
 QUANTILE_PARAM_NAME = "QUANTILE_LEVELS"
 POES_PARAM_NAME = "POES_HAZARD_MAPS"
 
+# type of the PoEs of the curves loaded in memory, single precision
+# is enough for probabilities and halves the size of the curves matrix
+POE_DTYPE = numpy.float32
+
+# number of computed curves stored in the kvs with a single call
+CURVES_BATCH_SIZE = 500
+
+# plotting positions used to compute the quantiles, the same
+# defaults used by scipy.stats.mstats.mquantiles
+QUANTILE_ALPHAP = 0.4
+QUANTILE_BETAP = 0.4
+
 
 def compute_mean_curve(curves):
     """Compute a mean hazard curve.
@@ -25,7 +33,13 @@ def compute_mean_curve(curves):
     The input parameter is a list of arrays where each array
     contains just the y values of the corresponding hazard curve.
     """
-    return numpy.array(curves).mean(axis=0)
+    curves = numpy.asarray(curves)
+
+    if not curves.size:
+        return []
+
+    # accumulate in double precision, the curves can be in single precision
+    return curves.mean(axis=0, dtype=numpy.float64)
 
 
 def compute_quantile_curve(curves, quantile):
@@ -34,12 +48,35 @@ def compute_quantile_curve(curves, quantile):
     The input parameter is a list of arrays where each array
     contains just the y values of the corresponding hazard curve.
     """
-    result = []
+    return compute_quantile_curves(curves, [quantile])[0]
 
-    if len(numpy.array(curves).flat):
-        result = mquantiles(curves, quantile, axis=0)[0]
-    
-    return result
+
+def compute_quantile_curves(curves, quantiles):
+    """Compute a quantile hazard curve for each of the given quantiles.
+
+    The input parameter is a list of arrays where each array
+    contains just the y values of the corresponding hazard curve.
+    Return a list with a quantile curve for each quantile, in the
+    same order of the quantiles given.
+    """
+    curves = numpy.array(curves, dtype=POE_DTYPE)
+
+    if not curves.size:
+        return [[] for _ in quantiles]
+
+    # sort the values of each IML once, then interpolate
+    # between the two order statistics around each quantile
+    curves.sort(axis=0)
+    realizations = len(curves)
+    quantiles = numpy.array(quantiles, dtype=float)
+
+    aleph = realizations * quantiles + QUANTILE_ALPHAP + quantiles * (
+            1.0 - QUANTILE_ALPHAP - QUANTILE_BETAP)
+    k = numpy.floor(numpy.minimum(
+            numpy.maximum(aleph, 1), realizations - 1)).astype(int)
+    gamma = numpy.minimum(numpy.maximum(aleph - k, 0.0), 1.0)[:, None]
+
+    return (1.0 - gamma) * curves[k - 1] + gamma * curves[k]
 
 
 def _extract_y_values_from(curve):
@@ -48,45 +85,102 @@ def _extract_y_values_from(curve):
     
     The serialized hazard curve has this format:
     {"site_lon": 1.0, "site_lat": 1.0, "curve": [{"x": 0.1, "y": 0.2}, ...]}
-    """
-    y_values = []
 
-    for point in curve:
-        y_values.append(float(point["y"]))
-        
-    return y_values
+    The y values are returned as a numpy array of POE_DTYPE.
+    """
+    return numpy.fromiter((point["y"] for point in curve),
+            dtype=POE_DTYPE, count=len(curve))
 
 def _reconstruct_curve_list_from(curve_array):
-    """Reconstruct the x,y hazard curve list from numpy array, and leave
-    out the un-needed x value."""
+    """Reconstruct the hazard curve list from numpy array, storing
+    just the y values (PoEs). The x values are the IMLs defined in
+    the configuration file, the same for all the curves.
+
+    The serialized mean and quantile hazard curves have this format:
+    {"site_lon": 1.0, "site_lat": 1.0, "curve": [0.2, 0.1, ...]}
+    """
     
-    return [{'y': poe} for poe in curve_array]
+    return numpy.asarray(curve_array, dtype=numpy.float64).tolist()
 
-def _acceptable(value):
-    """Return true if the value taken from the configuration
-    file is valid, false otherwise."""
-    try:
-        value = float(value)
-        return value >= 0.0 and value <= 1.0
+def curves_at(curve_keys, out=None):
+    """Return the y values of the json deserialized hazard curves
+    stored at the given keys (different realizations of a single site).
 
-    except ValueError:
-        return False
+    The curves are returned as the rows of a (curves x IMLs) matrix,
+    the out matrix is filled and returned when it has the right shape,
+    so that the same buffer can be used for all the sites.
+    """
+    raw_curves = []
 
+    # the realizations not computed (yet) are skipped
+    if curve_keys:
+        raw_curves = [raw_curve for raw_curve in kvs.get_client(
+                binary=False).mget(curve_keys) if raw_curve is not None]
 
-def curves_at(job_id, site):
-    """Return all the json deserialized hazard curves for
-    a single site (different realizations)."""
-    pattern = "%s*%s*%s*%s" % (kvs.tokens.HAZARD_CURVE_KEY_TOKEN,
-            job_id, site.longitude, site.latitude)
+    if not raw_curves:
+        return numpy.empty((0, 0), dtype=POE_DTYPE)
 
-    curves = []
-    raw_curves = kvs.mget_decoded(pattern)
+    curves = None
+
+    for row, raw_curve in enumerate(raw_curves):
+        y_values = _extract_y_values_from(
+                kvs.JSON_DECODER.decode(raw_curve)["curve"])
+
+        if curves is None:
+            shape = (len(raw_curves), len(y_values))
+            curves = out if out is not None and out.shape == shape \
+                    and out.dtype == POE_DTYPE \
+                    else numpy.empty(shape, dtype=POE_DTYPE)
+
+        curves[row] = y_values
 
-    for raw_curve in raw_curves:
-        curves.append(_extract_y_values_from(raw_curve["curve"]))
-    
     return curves
 
+def realization_curve_keys(job_id, site, realizations):
+    """Return the KVS keys of the hazard curves computed for
+    the given site, one for each realization of the logic tree."""
+    return [kvs.tokens.hazard_curve_key(job_id, realization,
+            site.longitude, site.latitude)
+            for realization in xrange(realizations)]
+
+def _realizations_of(job):
+    """Return the number of logic tree realizations of the job."""
+    return int(job.params["NUMBER_OF_LOGIC_TREE_SAMPLES"])
+
+def curve_keys_by_site(job_id, hc_token=kvs.tokens.HAZARD_CURVE_KEY_TOKEN):
+    """Return the KVS keys of all the hazard curves (different
+    realizations, or mean and quantile curves depending on the
+    token given) of a job, grouped by site.
+
+    The keys are loaded with a single scan of the KVS, the returned
+    dictionary maps the site key (see _site_key) to the list of
+    keys of the curves computed for that site.
+    """
+    pattern = kvs.generate_key([hc_token, job_id, "*"])
+
+    curve_keys = {}
+
+    for key in kvs.get_keys(pattern) or []:
+        curve_keys.setdefault(_site_key_from(key), []).append(key)
+
+    return curve_keys
+
+def _site_key(site):
+    """Return the (longitude, latitude) pair used in the
+    KVS keys of the hazard curves computed for the given site."""
+    return (str(site.longitude), str(site.latitude))
+
+def _site_key_from(kvs_key):
+    """Return the (longitude, latitude) pair of a hazard curve KVS key."""
+    parts = kvs_key.split(kvs.MEMCACHE_KEY_SEPARATOR)
+
+    # the site comes after product token and job ID, and
+    # after the realization for the single realization curves
+    if parts[0] == kvs.tokens.HAZARD_CURVE_KEY_TOKEN:
+        return tuple(parts[3:5])
+
+    return tuple(parts[2:4])
+
 def hazard_curve_keys_for_job(job_id, sites, 
                               hc_token=kvs.tokens.HAZARD_CURVE_KEY_TOKEN):
     """Return the KVS keys of hazard curves for a given job_id
@@ -94,12 +188,10 @@ def hazard_curve_keys_for_job(job_id, sites,
     """
 
     kvs_keys = []
+    curve_keys = curve_keys_by_site(job_id, hc_token)
+
     for site in sites:
-        pattern = "%s*%s*%s*%s" % (hc_token, job_id, site.longitude, 
-                                   site.latitude)
-        curr_keys = kvs.get_keys(pattern)
-        if curr_keys is not None and len(curr_keys) > 0:
-            kvs_keys.extend(curr_keys)
+        kvs_keys.extend(curve_keys.get(_site_key(site), []))
     
     return kvs_keys
 
@@ -122,36 +214,67 @@ def _extract_values_from_config(job, param_name):
     values = []
 
     if job.has(param_name):
-        raw_values = job.params[param_name].split()
-        values = [float(x) for x in raw_values if _acceptable(x)]
+        for raw_value in job.params[param_name].split():
+            try:
+                value = float(raw_value)
+            except ValueError:
+                continue
+
+            # just values in the [0, 1] range are valid
+            if 0.0 <= value <= 1.0:
+                values.append(value)
 
     return values
 
 
-def compute_mean_hazard_curves(job_id, sites):
+def compute_mean_hazard_curves(job, sites):
     """Compute a mean hazard curve for each site in the list
-    using as input all the pre-computed curves for different realizations."""
+    using as input all the pre-computed curves for different realizations.
+
+    The NUMBER_OF_LOGIC_TREE_SAMPLES parameter in the configuration file
+    specifies the realizations to read for each site.
+    """
 
     keys = []
+    curves = None
+    pending_curves = {}
+    realizations = _realizations_of(job)
+
+    # just the curves of a single site are kept in memory
     for site in sites:
+        curves = curves_at(realization_curve_keys(
+                job.id, site, realizations), curves)
+
         mean_curve = {"site_lon": site.longitude, "site_lat": site.latitude,
-            "curve": _reconstruct_curve_list_from(compute_mean_curve(
-            curves_at(job_id, site)))}
+            "curve": _reconstruct_curve_list_from(compute_mean_curve(curves))}
 
-        key = kvs.tokens.mean_hazard_curve_key(job_id, site)
+        key = kvs.tokens.mean_hazard_curve_key(job.id, site)
         keys.append(key)
 
-        kvs.set_value_json_encoded(key, mean_curve)
+        pending_curves[key] = mean_curve
+        _store_when_full(pending_curves)
+
+    kvs.set_values_json_encoded(pending_curves)
 
     return keys
 
 
+def _store_when_full(pending_curves):
+    """Store the pending curves in kvs, with a single call, when
+    there are at least CURVES_BATCH_SIZE of them."""
+
+    if len(pending_curves) >= CURVES_BATCH_SIZE:
+        kvs.set_values_json_encoded(pending_curves)
+        pending_curves.clear()
+
+
 def compute_quantile_hazard_curves(job, sites):
     """Compute a quantile hazard curve for each site in the list
     using as input all the pre-computed curves for different realizations.
     
     The QUANTILE_LEVELS parameter in the configuration file specifies
-    all the values used in the computation.
+    all the values used in the computation, NUMBER_OF_LOGIC_TREE_SAMPLES
+    the realizations to read for each site.
     """
 
     keys = []
@@ -159,19 +282,34 @@ def compute_quantile_hazard_curves(job, sites):
 
     LOG.debug("[QUANTILE_HAZARD_CURVES] List of quantiles is %s" % quantiles)
 
+    if not quantiles:
+        return keys
+
+    curves = None
+    pending_curves = {}
+    realizations = _realizations_of(job)
+
+    # just the curves of a single site are kept in memory
     for site in sites:
-        for quantile in quantiles:
+        curves = curves_at(realization_curve_keys(
+                job.id, site, realizations), curves)
+        quantile_curves = compute_quantile_curves(curves, quantiles)
+
+        for quantile, curve in zip(quantiles, quantile_curves):
 
             quantile_curve = {"site_lat": site.latitude,
                 "site_lon": site.longitude, 
-                "curve": _reconstruct_curve_list_from(compute_quantile_curve(
-                curves_at(job.id, site), quantile))}
+                "curve": _reconstruct_curve_list_from(curve)}
 
             key = kvs.tokens.quantile_hazard_curve_key(
                     job.id, site, quantile)
             keys.append(key)
 
-            kvs.set_value_json_encoded(key, quantile_curve)
+            pending_curves[key] = quantile_curve
+
+        _store_when_full(pending_curves)
+
+    kvs.set_values_json_encoded(pending_curves)
 
     return keys
 
@@ -182,40 +320,34 @@ def _extract_imls_from_config(job):
             "INTENSITY_MEASURE_LEVELS"].split(",")]
 
 
-def _get_iml_from(curve, job, poe):
-    """Return the interpolated IML using the values defined in
-    the INTENSITY_MEASURE_LEVELS parameter as the reference grid to
-    interpolate in.
+def _reversed_log_imls_from_config(job):
+    """Return the logarithms of the IMLs defined in the configuration
+    file in descending order, the grid used to interpolate the IMLs
+    of the hazard maps (see _get_imls_from)."""
+    return numpy.log(numpy.array(_extract_imls_from_config(job))[::-1])
+
+
+def _get_imls_from(curve, imls, poes):
+    """Return the interpolated IMLs, one for each of the given PoEs,
+    using the values defined in the INTENSITY_MEASURE_LEVELS parameter
+    as the reference grid to interpolate in.
     
     IML from config is in ascending order (abscissa of hazard curve)
     PoE from curve is in descending order (ordinate of hazard curve)
 
     In our interpolation, PoE becomes the x axis, IML the y axis, therefore
     the arrays have to be reversed (x axis has to be monotonically 
-    increasing).
+    increasing). The imls given are already reversed and in
+    logarithmic form, see _reversed_log_imls_from_config.
     """
 
-    # reverse arrays
-    poes = numpy.array(_extract_y_values_from(curve["curve"]))[::-1]
-    imls = numpy.log(numpy.array(_extract_imls_from_config(job))[::-1])
-
-    site = shapes.Site(curve["site_lon"], curve["site_lat"])
+    # reverse array, just once for all the PoEs
+    curve_poes = numpy.asarray(curve["curve"], dtype=numpy.float64)[::-1]
 
-    if poe > poes[-1]:
-        LOG.debug("[HAZARD_MAP] Interpolation out of bounds for PoE %s, "\
-            "using maximum PoE value pair, PoE: %s, IML: %s, at site %s" % (
-            poe, poes[-1], math.exp(imls[-1]), site))
-        return math.exp(imls[-1])
+    # out of bounds PoEs take the IML of the nearest end of the curve
+    return numpy.exp(numpy.interp(poes, curve_poes, imls))
 
-    if poe < poes[0]:
-        LOG.debug("[HAZARD_MAP] Interpolation out of bounds for PoE %s, "\
-            "using minimum PoE value pair, PoE: %s, IML: %s, at site %s" % (
-            poe, poes[0], math.exp(imls[0]), site))
-        return math.exp(imls[0])
-
-    return math.exp(interp1d(poes, imls, kind='linear')(poe))
-
-def _store_iml_for(curve, key, job, poe):
+def _store_iml_for(curve, key, iml, vs30):
     """Store an interpolated IML in kvs along with all
     the needed metadata."""
 
@@ -223,18 +355,31 @@ def _store_iml_for(curve, key, job, poe):
 
     im_level["site_lon"] = curve["site_lon"]
     im_level["site_lat"] = curve["site_lat"]
-    im_level["vs30"] = float(job.params["REFERENCE_VS30_VALUE"])
-    im_level["IML"] = _get_iml_from(curve, job, poe)
+    im_level["vs30"] = vs30
+    im_level["IML"] = float(iml)
 
     kvs.set_value_json_encoded(key, im_level)
 
 
-def compute_quantile_hazard_maps(job):
+def _curves_stored_at(keys):
+    """Return the json deserialized curves stored at the given keys,
+    skipping the keys with no value stored."""
+    if not keys:
+        return []
+
+    return [kvs.JSON_DECODER.decode(raw_curve) for raw_curve in
+            kvs.get_client(binary=False).mget(keys) if raw_curve is not None]
+
+
+def compute_quantile_hazard_maps(job, sites=None):
     """Compute quantile hazard maps using as input all the
     pre computed quantile hazard curves.
 
     The POES_HAZARD_MAPS parameter in the configuration file specifies
     all the values used in the computation.
+
+    When a list of sites is given, the maps are computed just for
+    those sites, so that the computation can be split in more tasks.
     """
 
     quantiles = _extract_values_from_config(job, QUANTILE_PARAM_NAME)
@@ -244,60 +389,91 @@ def compute_quantile_hazard_maps(job):
     LOG.debug("[QUANTILE_HAZARD_MAPS] List of quantiles is %s" % quantiles)
 
     keys = []
-    for quantile in quantiles:
-        # get all the pre computed quantile curves
-        pattern = "%s*%s*%s" % (kvs.tokens.QUANTILE_HAZARD_CURVE_KEY_TOKEN,
-                job.id, quantile)
 
-        quantile_curves = kvs.mget_decoded(pattern)
+    if not poes:
+        return keys
+
+    # the configuration doesn't change during the job
+    imls = _reversed_log_imls_from_config(job)
+    vs30 = float(job.params["REFERENCE_VS30_VALUE"])
+
+    for quantile in quantiles:
+        # get the pre computed quantile curves
+        if sites is None:
+            pattern = "%s*%s*%s" % (
+                    kvs.tokens.QUANTILE_HAZARD_CURVE_KEY_TOKEN,
+                    job.id, quantile)
+
+            quantile_curves = kvs.mget_decoded(pattern)
+        else:
+            quantile_curves = _curves_stored_at(
+                    [kvs.tokens.quantile_hazard_curve_key(
+                    job.id, site, quantile) for site in sites])
 
         LOG.debug("[QUANTILE_HAZARD_MAPS] Found %s pre computed " \
                 "quantile curves for quantile %s"
                 % (len(quantile_curves), quantile))
 
-        for poe in poes:
-            for quantile_curve in quantile_curves:
-                site = shapes.Site(quantile_curve["site_lon"],
-                                   quantile_curve["site_lat"])
+        for quantile_curve in quantile_curves:
+            site = shapes.Site(quantile_curve["site_lon"],
+                               quantile_curve["site_lat"])
+
+            for poe, iml in zip(poes,
+                    _get_imls_from(quantile_curve, imls, poes)):
 
                 key = kvs.tokens.quantile_hazard_map_key(
                         job.id, site, poe, quantile)
                 keys.append(key)
 
-                _store_iml_for(quantile_curve, key, job, poe)
+                _store_iml_for(quantile_curve, key, iml, vs30)
                 
     return keys
 
 
-def compute_mean_hazard_maps(job):
+def compute_mean_hazard_maps(job, sites=None):
     """Compute mean hazard maps using as input all the
     pre computed mean hazard curves.
     
     The POES_HAZARD_MAPS parameter in the configuration file specifies
     all the values used in the computation.
+
+    When a list of sites is given, the maps are computed just for
+    those sites, so that the computation can be split in more tasks.
     """
 
     poes = _extract_values_from_config(job, POES_PARAM_NAME)
 
     LOG.debug("[MEAN_HAZARD_MAPS] List of POEs is %s" % poes)
 
-    # get all the pre computed mean curves
-    pattern = "%s*%s*" % (kvs.tokens.MEAN_HAZARD_CURVE_KEY_TOKEN, job.id)
-    mean_curves = kvs.mget_decoded(pattern)
+    keys = []
+
+    if not poes:
+        return keys
+
+    # the configuration doesn't change during the job
+    imls = _reversed_log_imls_from_config(job)
+    vs30 = float(job.params["REFERENCE_VS30_VALUE"])
+
+    # get the pre computed mean curves
+    if sites is None:
+        pattern = "%s*%s*" % (kvs.tokens.MEAN_HAZARD_CURVE_KEY_TOKEN, job.id)
+        mean_curves = kvs.mget_decoded(pattern)
+    else:
+        mean_curves = _curves_stored_at([kvs.tokens.mean_hazard_curve_key(
+                job.id, site) for site in sites])
 
     LOG.debug("[MEAN_HAZARD_MAPS] Found %s pre computed mean curves"
             % len(mean_curves))
 
-    keys = []
-    for poe in poes:
-        for mean_curve in mean_curves:
-            site = shapes.Site(mean_curve["site_lon"],
-                               mean_curve["site_lat"])
+    for mean_curve in mean_curves:
+        site = shapes.Site(mean_curve["site_lon"],
+                           mean_curve["site_lat"])
 
+        for poe, iml in zip(poes, _get_imls_from(mean_curve, imls, poes)):
             key = kvs.tokens.mean_hazard_map_key(
                     job.id, site, poe)
             keys.append(key)
 
-            _store_iml_for(mean_curve, key, job, poe)
+            _store_iml_for(mean_curve, key, iml, vs30)
             
     return keys
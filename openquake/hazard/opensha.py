@@ -17,6 +17,7 @@ from openquake import shapes
 from openquake.hazard import classical_psha
 from openquake.hazard import job
 from openquake.hazard import tasks
+from openquake.job import SITES_PER_BLOCK
 from openquake.job.mixins import Mixin
 from openquake.kvs import tokens
 from openquake.output import geotiff
@@ -233,8 +234,8 @@ class ClassicalMixin(BasePSHAMixin):
 
             if self.params[classical_psha.POES_PARAM_NAME] != '':
                 LOG.info('Computing/serializing mean hazard maps')
-                results_mean_maps = classical_psha.compute_mean_hazard_maps(
-                    self)
+                results_mean_maps = self.distribute_hazard_maps(
+                    tasks.compute_mean_maps)
                 self.write_hazardmap_file(results_mean_maps)
                 del results_mean_maps
 
@@ -251,8 +252,8 @@ class ClassicalMixin(BasePSHAMixin):
             len(quantile_values) > 0):
 
             LOG.info('Computing quantile hazard maps')
-            results_quantile_maps = \
-                classical_psha.compute_quantile_hazard_maps(self)
+            results_quantile_maps = self.distribute_hazard_maps(
+                tasks.compute_quantile_maps)
 
             quantile_values = _collect_map_keys_per_quantile(
                 results_quantile_maps)
@@ -264,6 +265,27 @@ class ClassicalMixin(BasePSHAMixin):
 
         return results
 
+    def distribute_hazard_maps(self, map_task):
+        """Spawn a hazard map task for each block of SITES_PER_BLOCK
+        sites, wait for all of them and return the KVS keys of the
+        computed maps."""
+
+        pending_tasks = []
+        results = []
+
+        for site_list in self.site_list_generator():
+            for start in xrange(0, len(site_list), SITES_PER_BLOCK):
+                pending_tasks.append(map_task.delay(
+                        self.id, site_list[start:start + SITES_PER_BLOCK]))
+
+        for task in pending_tasks:
+            task.wait()
+            if task.status != 'SUCCESS': 
+                raise Exception(task.result)
+            results.extend(task.result)
+
+        return results
+
     def write_hazardcurve_file(self, curve_keys):
         """Generate a NRML file with hazard curves for a collection of 
         hazard curves from KVS, identified through their KVS keys.
@@ -359,15 +381,17 @@ class ClassicalMixin(BasePSHAMixin):
 
             # use hazard curve ordinate values (PoE) from KVS
             # NOTE(fab): At the moment, the IMLs are stored along with the 
-            # PoEs in KVS. However, we are using the IML list from config.
-            # The IMLs from KVS are ignored. Note that IMLs from KVS are
-            # in logarithmic form, but the ones from config are not.
-            # The way of storing the HC data in KVS is not very
-            # efficient, we should store the abscissae and ordinates
-            # separately as lists and not make pairs of them
-            curve_poe = []
-            for curve_pair in hc['curve']:
-                curve_poe.append(float(curve_pair['y']))
+            # PoEs in KVS for the single realizations. However, we are
+            # using the IML list from config. The IMLs from KVS are
+            # ignored. Note that IMLs from KVS are in logarithmic form,
+            # but the ones from config are not. Mean and quantile curves
+            # store just the list of PoEs.
+            if curve_mode == 'realization':
+                curve_poe = []
+                for curve_pair in hc['curve']:
+                    curve_poe.append(float(curve_pair['y']))
+            else:
+                curve_poe = hc['curve']
 
             hc_attrib = {'investigationTimeSpan': 
                             self.params['INVESTIGATION_TIME'],
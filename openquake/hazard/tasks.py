@@ -6,6 +6,10 @@ The following tasks are defined in the hazard engine:
     * generate_erf
     * compute_hazard_curve
     * compute_mgm_intensity
+    * compute_mean_curves
+    * compute_quantile_curves
+    * compute_mean_maps
+    * compute_quantile_maps
 """
 
 import json
@@ -101,7 +105,9 @@ def compute_mean_curves(job_id, sites):
     logger.info("Computing MEAN curves for %s sites (job_id %s)"
             % (len(sites), job_id))
 
-    return classical_psha.compute_mean_hazard_curves(job_id, sites)
+    engine = job.Job.from_kvs(job_id)
+
+    return classical_psha.compute_mean_hazard_curves(engine, sites)
     #subtask(compute_quantile_curves).delay(job_id, sites)
 
 @task
@@ -118,3 +124,31 @@ def compute_quantile_curves(job_id, sites):
 
     return classical_psha.compute_quantile_hazard_curves(engine, sites)
     #subtask(serialize_quantile_curves).delay(job_id, sites)
+
+@task
+def compute_mean_maps(job_id, sites):
+    """Compute the mean hazard map for each site given."""
+
+    # pylint: disable=E1101
+    logger = compute_mean_maps.get_logger()
+
+    logger.info("Computing MEAN maps for %s sites (job_id %s)"
+            % (len(sites), job_id))
+
+    engine = job.Job.from_kvs(job_id)
+
+    return classical_psha.compute_mean_hazard_maps(engine, sites)
+
+@task
+def compute_quantile_maps(job_id, sites):
+    """Compute the quantile hazard maps for each site given."""
+
+    # pylint: disable=E1101
+    logger = compute_quantile_maps.get_logger()
+
+    logger.info("Computing QUANTILE maps for %s sites (job_id %s)"
+            % (len(sites), job_id))
+
+    engine = job.Job.from_kvs(job_id)
+
+    return classical_psha.compute_quantile_hazard_maps(engine, sites)
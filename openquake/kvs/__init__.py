@@ -17,6 +17,10 @@ MAX_LENGTH_RANDOM_ID = 36
 MEMCACHE_KEY_SEPARATOR = '!'
 SITES_KEY_TOKEN = "sites"
 
+# the encoder and decoder are stateless, so they are shared by all the calls
+JSON_DECODER = json.JSONDecoder()
+JSON_ENCODER = json.JSONEncoder()
+
 
 def flush():
     """Flush (delete) all the values stored in the underlying kvs system."""
@@ -48,10 +52,9 @@ def mget_decoded(regexp):
     satisfy the given regexp."""
 
     decoded_values = []
-    decoder = json.JSONDecoder()
 
     for value in mget(regexp):
-        decoded_values.append(decoder.decode(value))
+        decoded_values.append(JSON_DECODER.decode(value))
 
     return decoded_values
 
@@ -107,8 +110,7 @@ def get_value_json_decoded(key):
     """ Get value from kvs and json decode """
     try:
         value = get_client(binary=False).get(key)
-        decoder = json.JSONDecoder()
-        return decoder.decode(value)
+        return JSON_DECODER.decode(value)
     except (TypeError, ValueError), e:
         print "Key was %s" % key
         print e
@@ -118,10 +120,8 @@ def get_value_json_decoded(key):
 
 def set_value_json_encoded(key, value):
     """ Encode value and set in kvs """
-    encoder = json.JSONEncoder()
-
     try:
-        encoded_value = encoder.encode(value)
+        encoded_value = JSON_ENCODER.encode(value)
         get_client(binary=False).set(key, encoded_value)
     except (TypeError, ValueError):
         raise ValueError("cannot encode value %s to JSON" % value)
@@ -129,6 +129,22 @@ def set_value_json_encoded(key, value):
     return True
 
 
+def set_values_json_encoded(values):
+    """ Encode the values of the given {key: value} dictionary and
+    set them in kvs with a single round trip """
+
+    try:
+        encoded_values = dict((key, JSON_ENCODER.encode(value))
+                for key, value in values.iteritems())
+    except (TypeError, ValueError):
+        raise ValueError("cannot encode values %s to JSON" % values)
+
+    if encoded_values:
+        get_client(binary=False).mset(encoded_values)
+
+    return True
+
+
 def set(key, encoded_value): #pylint: disable=W0622
     """ Set value in kvs, for objects that have their own encoding method. """
 
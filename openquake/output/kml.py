@@ -7,8 +7,7 @@ rather than generating a giant dom and then writing it to file.
 
 """
 
-from lxml import etree
-from lxml.builder import E
+import itertools
 
 from openquake import writer
 
@@ -36,6 +35,22 @@ KML_FOOTER = """
 </kml>
 """
 
+# a single point of a linestring, the altitude is fixed
+COORDINATE_FORMAT = '%f,%f,2357'
+
+PLACEMARK_TEMPLATE = """<Placemark>
+  <name>foo</name>
+  <description>bar</description>
+  <styleUrl>#yellowLineGreenpoly</styleUrl>
+  <LineString>
+    <extrude>1</extrude>
+    <tesselate>1</tesselate>
+    <altitudeMode>absolute</altitudeMode>
+    <coordinates>%s</coordinates>
+  </LineString>
+</Placemark>
+"""
+
 
 class KmlFile(writer.FileWriter):
     """Example output class.
@@ -49,25 +64,13 @@ class KmlFile(writer.FileWriter):
         self.file.write(KML_HEADER.strip())
 
     def write(self, cell, value):
-        # cell to kml linestring
-        linestring = []
-        for x, y in cell.coords:
-            linestring.append('%f,%f,2357' % (x, y))
-
-        placemark = (E.Placemark(
-                        E.name('foo'),
-                        E.description('bar'),
-                        E.styleUrl('#yellowLineGreenpoly'),
-                        E.LineString(
-                            E.extrude('1'),
-                            E.tesselate('1'),
-                            E.altitudeMode('absolute'),
-                            E.coordinates('\n'.join(linestring))
-                            )
-                        )
-                     )
-
-        self.file.write(etree.tostring(placemark, pretty_print=True))
+        # cell to kml linestring, all the points are formatted at once
+        points = list(cell.coords)
+        linestring = '\n'.join([COORDINATE_FORMAT] * len(points)) % (
+                tuple(itertools.chain(*points)))
+
+        # just numbers in the coordinates, nothing to escape
+        self.file.write(PLACEMARK_TEMPLATE % linestring)
 
     def close(self):
         self.file.write(KML_FOOTER.strip())
@@ -448,6 +448,9 @@ class MeanHazardCurveComputationTestCase(unittest.TestCase):
     def setUp(self):
         self.job_id = 1234
 
+        self.params = {"NUMBER_OF_LOGIC_TREE_SAMPLES": 6}
+        self.engine = job.Job(self.params, self.job_id)
+
         self.expected_mean_curve = numpy.array([9.8542200e-01, 9.8196600e-01,
                 9.5842000e-01, 9.2639600e-01, 8.6713000e-01, 7.7081800e-01,
                 6.3448600e-01, 4.7256800e-01, 3.3523400e-01, 3.1255000e-01,
@@ -541,6 +544,120 @@ class MeanHazardCurveComputationTestCase(unittest.TestCase):
         # no values
         self.assertTrue(numpy.allclose([], numpy.array(result["curve"])))
 
+    def test_groups_the_curves_of_a_job_by_site(self):
+        hazard_curve = {"site_lon": 2.0, "site_lat": 5.0, "curve": [
+                {"y": 9.8161000e-01, "x": 0}, {"y": 9.7837000e-01, "x": 0}]}
+
+        self._store_hazard_curve_at(shapes.Site(2.0, 5.0), hazard_curve, 1)
+        self._store_hazard_curve_at(shapes.Site(2.0, 5.0), hazard_curve, 2)
+        self._store_hazard_curve_at(shapes.Site(1.5, 1.0), hazard_curve, 1)
+
+        # a curve of another job
+        kvs.set_value_json_encoded(kvs.tokens.hazard_curve_key(
+                self.job_id + 1, 1, 2.0, 5.0), hazard_curve)
+
+        curve_keys = classical_psha.curve_keys_by_site(self.job_id)
+
+        self.assertEqual(2, len(curve_keys))
+        self.assertEqual(2, len(curve_keys[("2.0", "5.0")]))
+        self.assertEqual(1, len(curve_keys[("1.5", "1.0")]))
+
+        curves = classical_psha.curves_at(curve_keys[("2.0", "5.0")])
+
+        self.assertEqual((2, 2), curves.shape)
+        self.assertTrue(numpy.allclose([9.8161000e-01, 9.7837000e-01],
+                curves[0]))
+
+    def test_reads_just_the_curves_of_the_realizations_of_the_job(self):
+        self._store_hazard_curve_at(shapes.Site(2.0, 5.0), {"curve": [
+                {"y": 0.2, "x": 0}, {"y": 0.1, "x": 0}]}, 0)
+        self._store_hazard_curve_at(shapes.Site(2.0, 5.0), {"curve": [
+                {"y": 0.4, "x": 0}, {"y": 0.3, "x": 0}]}, 2)
+
+        # realization outside the logic tree samples of the job
+        self._store_hazard_curve_at(shapes.Site(2.0, 5.0), {"curve": [
+                {"y": 0.9, "x": 0}, {"y": 0.9, "x": 0}]}, 6)
+
+        self._run([shapes.Site(2.0, 5.0)])
+
+        result = kvs.get_value_json_decoded(
+                kvs.tokens.mean_hazard_curve_key(
+                self.job_id, shapes.Site(2.0, 5.0)))
+
+        self.assertTrue(numpy.allclose([0.3, 0.2], result["curve"]))
+
+    def test_stores_all_the_curves_when_more_batches_are_needed(self):
+        sites = [shapes.Site(1.5, 1.0), shapes.Site(2.0, 1.0),
+                shapes.Site(1.5, 1.5), shapes.Site(2.0, 1.5),
+                shapes.Site(2.0, 5.0)]
+
+        for site in sites:
+            self._store_hazard_curve_at(site, self.empty_curve)
+
+        batch_size = classical_psha.CURVES_BATCH_SIZE
+        classical_psha.CURVES_BATCH_SIZE = 2
+
+        try:
+            keys = classical_psha.compute_mean_hazard_curves(
+                    self.engine, sites)
+        finally:
+            classical_psha.CURVES_BATCH_SIZE = batch_size
+
+        self.assertEqual(len(sites), len(keys))
+
+        for site in sites:
+            self._has_computed_mean_curve_for_site(site)
+
+    def test_returns_the_curve_keys_just_for_the_sites_given(self):
+        self._store_hazard_curve_at(shapes.Site(2.0, 5.0), self.empty_curve, 1)
+        self._store_hazard_curve_at(shapes.Site(2.0, 5.0), self.empty_curve, 2)
+        self._store_hazard_curve_at(shapes.Site(12.0, 5.0), self.empty_curve)
+        self._store_hazard_curve_at(shapes.Site(1.5, 1.0), self.empty_curve)
+
+        keys = classical_psha.hazard_curve_keys_for_job(self.job_id,
+                [shapes.Site(2.0, 5.0), shapes.Site(3.0, 3.0)])
+
+        self.assertEqual(sorted([
+                kvs.tokens.hazard_curve_key(self.job_id, 1, 2.0, 5.0),
+                kvs.tokens.hazard_curve_key(self.job_id, 2, 2.0, 5.0)]),
+                sorted(keys))
+
+    def test_returns_the_mean_curve_keys_for_the_sites_given(self):
+        self._store_hazard_curve_at(shapes.Site(2.0, 5.0), self.empty_curve)
+        self._store_hazard_curve_at(shapes.Site(1.5, 1.0), self.empty_curve)
+
+        self._run([shapes.Site(2.0, 5.0), shapes.Site(1.5, 1.0)])
+
+        self.assertEqual([kvs.tokens.mean_hazard_curve_key(
+                self.job_id, shapes.Site(1.5, 1.0))],
+                classical_psha.mean_hazard_curve_keys_for_job(
+                self.job_id, [shapes.Site(1.5, 1.0)]))
+
+    def test_reuses_the_given_buffer_for_the_curves(self):
+        hazard_curve = {"site_lon": 2.0, "site_lat": 5.0, "curve": [
+                {"y": 9.8161000e-01, "x": 0}, {"y": 9.7837000e-01, "x": 0}]}
+
+        self._store_hazard_curve_at(shapes.Site(2.0, 5.0), hazard_curve, 1)
+
+        buf = numpy.zeros((1, 2), dtype=classical_psha.POE_DTYPE)
+
+        curves = classical_psha.curves_at(
+                classical_psha.realization_curve_keys(
+                self.job_id, shapes.Site(2.0, 5.0), 6), buf)
+
+        self.assertTrue(curves is buf)
+        self.assertTrue(numpy.allclose([9.8161000e-01, 9.7837000e-01],
+                buf[0]))
+
+    def test_a_site_without_curves_produces_an_empty_mean_curve(self):
+        self._run([shapes.Site(2.0, 5.0)])
+
+        result = kvs.get_value_json_decoded(
+                kvs.tokens.mean_hazard_curve_key(
+                self.job_id, shapes.Site(2.0, 5.0)))
+
+        self.assertEqual([], result["curve"])
+
     def test_reads_and_stores_the_mean_curve_in_kvs(self):
         hazard_curve_1 = {"site_lon": 2.0, "site_lat": 5.0, "curve": [
                 {"y": 9.8161000e-01, "x": 0}, {"y": 9.7837000e-01, "x": 0},
@@ -620,11 +737,11 @@ class MeanHazardCurveComputationTestCase(unittest.TestCase):
         
         # values are correct
         self.assertTrue(numpy.allclose(self.expected_mean_curve,
-                classical_psha._extract_y_values_from(result["curve"])))
+                numpy.array(result["curve"])))
 
     def _run(self, sites):
         classical_psha.compute_mean_hazard_curves(
-                self.job_id, sites)
+                self.engine, sites)
 
     def _store_hazard_curve_at(self, site, curve, realization=1):
         kvs.set_value_json_encoded(
@@ -641,7 +758,7 @@ class QuantileHazardCurveComputationTestCase(unittest.TestCase):
     def setUp(self):
         self.job_id = 1234
         
-        self.params = {}
+        self.params = {"NUMBER_OF_LOGIC_TREE_SAMPLES": 6}
         self.quantiles_levels = classical_psha.QUANTILE_PARAM_NAME
         self.engine = job.Job(self.params,  self.job_id)
 
@@ -771,6 +888,30 @@ class QuantileHazardCurveComputationTestCase(unittest.TestCase):
         self.assertTrue(numpy.allclose(
                 self.expected_curve, quantile_hazard_curve, atol=0.005))
 
+    def test_computes_all_the_quantile_curves_at_once(self):
+        hazard_curves = [numpy.array([9.8161000e-01, 6.5708000e-01,
+                2.0502000e-01, 5.4791000e-03]),
+                numpy.array([9.7309000e-01, 6.1272000e-01,
+                1.8340000e-01, 4.5924000e-03]),
+                numpy.array([9.9178000e-01, 6.4627000e-01,
+                1.7279000e-01, 8.1923000e-03])]
+
+        quantiles = [0.25, 0.50, 0.75]
+
+        expected_curves = [
+                [9.74794e-01, 6.19430e-01, 1.74912e-01, 4.76974e-03],
+                [9.81610e-01, 6.46270e-01, 1.83400e-01, 5.47910e-03],
+                [9.89746e-01, 6.54918e-01, 2.00696e-01, 7.64966e-03]]
+
+        quantile_hazard_curves = classical_psha.compute_quantile_curves(
+                hazard_curves, quantiles)
+
+        self.assertEqual(len(quantiles), len(quantile_hazard_curves))
+
+        for expected_curve, curve in zip(
+                expected_curves, quantile_hazard_curves):
+            self.assertTrue(numpy.allclose(expected_curve, curve))
+
     def test_an_empty_hazard_curve_produces_an_empty_quantile_curve(self):
         hazard_curve = {"site_lon": 2.0, "site_lat": 5.0, "curve": []}
         self._store_hazard_curve_at(shapes.Site(2.0, 5.0), hazard_curve)
@@ -871,8 +1012,7 @@ class QuantileHazardCurveComputationTestCase(unittest.TestCase):
 
         # values are correct
         self.assertTrue(numpy.allclose(self.expected_curve,
-                classical_psha._extract_y_values_from(result["curve"]), 
-                atol=0.005))
+                numpy.array(result["curve"]), atol=0.005))
 
     def _run(self, sites):
         classical_psha.compute_quantile_hazard_curves(
@@ -1081,6 +1221,88 @@ class MeanQuantileHazardMapsComputationTestCase(unittest.TestCase):
         self.assertTrue(kvs.get(kvs.tokens.quantile_hazard_map_key(
                 self.job_id, shapes.Site(3.5, 3.5), 0.10, 0.75)))
 
+    def test_computes_the_maps_just_for_the_sites_given(self):
+        self.params[self.poes_levels] = "0.10"
+
+        mean_curve = {"site_lon": 3.0, "site_lat": 3.0,
+                "curve": classical_psha._reconstruct_curve_list_from(
+                [9.8784e-01, 9.8405e-01, 9.5719e-01, 9.1955e-01,
+                8.5019e-01, 7.4038e-01, 5.9153e-01, 4.2626e-01, 2.9755e-01,
+                2.7731e-01, 1.6218e-01, 8.8035e-02, 4.3499e-02, 1.9065e-02,
+                7.0442e-03, 2.1300e-03, 4.9498e-04, 8.1768e-05, 7.3425e-06])}
+
+        self._store_curve_at(shapes.Site(3.0, 3.0), mean_curve)
+
+        keys = classical_psha.compute_mean_hazard_maps(
+                self.engine, [shapes.Site(3.0, 3.0), shapes.Site(4.0, 4.0)])
+
+        self.assertEqual([kvs.tokens.mean_hazard_map_key(
+                self.job_id, shapes.Site(3.0, 3.0), 0.10)], keys)
+
+        self._has_computed_IML_for_site(shapes.Site(3.0, 3.0), 0.10)
+        self._no_stored_values_for(kvs.tokens.mean_hazard_map_key(
+                self.job_id, shapes.Site(2.0, 5.0), 0.10))
+
+    def test_computes_the_quantile_maps_just_for_the_sites_given(self):
+        self.params[self.poes_levels] = "0.10"
+        self.params[self.quantiles_levels] = "0.25"
+
+        curve = {"site_lon": 3.0, "site_lat": 3.0,
+                "curve": classical_psha._reconstruct_curve_list_from(
+                [9.8784e-01, 9.8405e-01, 9.5719e-01, 9.1955e-01,
+                8.5019e-01, 7.4038e-01, 5.9153e-01, 4.2626e-01, 2.9755e-01,
+                2.7731e-01, 1.6218e-01, 8.8035e-02, 4.3499e-02, 1.9065e-02,
+                7.0442e-03, 2.1300e-03, 4.9498e-04, 8.1768e-05, 7.3425e-06])}
+
+        kvs.set_value_json_encoded(kvs.tokens.quantile_hazard_curve_key(
+                self.job_id, shapes.Site(3.0, 3.0), 0.25), curve)
+
+        kvs.set_value_json_encoded(kvs.tokens.quantile_hazard_curve_key(
+                self.job_id, shapes.Site(3.5, 3.5), 0.25), curve)
+
+        keys = classical_psha.compute_quantile_hazard_maps(
+                self.engine, [shapes.Site(3.0, 3.0)])
+
+        self.assertEqual([kvs.tokens.quantile_hazard_map_key(
+                self.job_id, shapes.Site(3.0, 3.0), 0.10, 0.25)], keys)
+
+        self.assertFalse(kvs.get(kvs.tokens.quantile_hazard_map_key(
+                self.job_id, shapes.Site(3.5, 3.5), 0.10, 0.25)))
+
+    def test_the_mean_maps_task_computes_the_maps_of_the_sites_given(self):
+        self.params[self.poes_levels] = "0.10"
+        self._store_job()
+
+        keys = tasks.compute_mean_maps(self.job_id, [shapes.Site(2.0, 5.0)])
+
+        self.assertEqual([kvs.tokens.mean_hazard_map_key(
+                self.job_id, shapes.Site(2.0, 5.0), 0.10)], keys)
+
+        self._has_computed_IML_for_site(shapes.Site(2.0, 5.0), 0.10)
+
+    def test_the_quantile_maps_task_computes_the_maps_of_the_sites_given(self):
+        self.params[self.poes_levels] = "0.10"
+        self.params[self.quantiles_levels] = "0.25"
+        self._store_job()
+
+        curve = kvs.get_value_json_decoded(kvs.tokens.mean_hazard_curve_key(
+                self.job_id, shapes.Site(2.0, 5.0)))
+
+        kvs.set_value_json_encoded(kvs.tokens.quantile_hazard_curve_key(
+                self.job_id, shapes.Site(2.0, 5.0), 0.25), curve)
+
+        keys = tasks.compute_quantile_maps(
+                self.job_id, [shapes.Site(2.0, 5.0)])
+
+        self.assertEqual([kvs.tokens.quantile_hazard_map_key(
+                self.job_id, shapes.Site(2.0, 5.0), 0.10, 0.25)], keys)
+
+        self.assertTrue(kvs.get(keys[0]))
+
+    def _store_job(self):
+        kvs.set_value_json_encoded(
+                kvs.generate_job_key(self.job_id), self.params)
+
     def _get_iml_at(self, site, poe):
         return kvs.mget_decoded("%s*%s*%s*%s*%s" %
                 (kvs.tokens.MEAN_HAZARD_MAP_KEY_TOKEN,
@@ -1103,3 +1325,58 @@ class MeanQuantileHazardMapsComputationTestCase(unittest.TestCase):
                 (kvs.tokens.MEAN_HAZARD_MAP_KEY_TOKEN,
                 self.job_id, site.longitude, site.latitude,
                 str(poe))))
+
+
+class FakeMapTask(object):
+    """A map task that records the sites it has been spawned for."""
+
+    def __init__(self):
+        self.site_lists = []
+
+    def delay(self, job_id, sites):
+        self.site_lists.append(sites)
+        return FakeMapTaskResult(["%s!%s" % (job_id, site) for site in sites])
+
+
+class FakeMapTaskResult(object):
+    """The result of a FakeMapTask, already successful."""
+
+    def __init__(self, result):
+        self.result = result
+        self.status = "SUCCESS"
+
+    def wait(self):
+        pass
+
+
+class HazardMapsDistributionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.params = {"HAZARD_CALCULATION_MODE": "Classical",
+                "REGION_VERTEX": "0.0, 0.0, 0.0, 1.0, 1.0, 1.0, 1.0, 0.0",
+                "REGION_GRID_SPACING": "0.1"}
+
+        self.engine = job.Job(self.params, 1234)
+        self.map_task = FakeMapTask()
+
+    def test_spawns_a_map_task_for_each_block_of_sites(self):
+        sites = []
+
+        for site_list in self.engine.site_list_generator():
+            sites.extend(site_list)
+
+        # the region is bigger than a single block
+        self.assertTrue(len(sites) > job.SITES_PER_BLOCK)
+
+        with mixins.Mixin(self.engine, openquake.hazard.job.HazJobMixin,
+                key="hazard"):
+            keys = self.engine.distribute_hazard_maps(self.map_task)
+
+        self.assertTrue(len(self.map_task.site_lists) > 1)
+
+        for site_list in self.map_task.site_lists:
+            self.assertTrue(len(site_list) <= job.SITES_PER_BLOCK)
+
+        # all the sites are dispatched, just once
+        self.assertEqual(sites, sum(self.map_task.site_lists, []))
+        self.assertEqual(len(sites), len(keys))
@@ -63,12 +63,12 @@ def simple_task_json_to_memcache(name, **kwargs):
 
     test_dict = {"list.%s" % name: [name, name], 
                  "dict.%s" % name: {name: name}}
-    test_dict_serialized = json.JSONEncoder().encode(test_dict)
+    test_dict_serialized = json.dumps(test_dict)
 
     memcache_client.set(name, test_dict_serialized)
     logger.info("wrote to json for memcache key %s" % (name))
 
 def _wait_a_bit():
     wait_time = random.randrange(0, MAX_WAIT_TIME_MILLISECS)
-    time.sleep(wait_time/1000)
+    time.sleep(wait_time / 1000.0)
     return wait_time